@@ -1,3 +1,4 @@
+import os
 import subprocess
 
 from moulinette import m18n
@@ -18,6 +19,8 @@ class MyMigration(Migration):
 
     def run(self):
 
+        self._installed_pkgs = self.list_installed_packages()
+
         if not self.package_is_installed("postgresql-9.6"):
             logger.warning(m18n.n("migration_0017_postgresql_96_not_installed"))
             return
@@ -26,57 +29,78 @@ class MyMigration(Migration):
             raise YunohostValidationError("migration_0017_postgresql_11_not_installed")
 
         # Make sure there's a 9.6 cluster
-        try:
-            self.runcmd("pg_lsclusters | grep -q '^9.6 '")
-        except Exception:
+        # (pg_lsclusters would parse the conf of every cluster just to tell us
+        # that, the conf directory of the cluster is enough)
+        if not os.path.isdir("/etc/postgresql/9.6/main"):
             logger.warning(
                 "It looks like there's not active 9.6 cluster, so probably don't need to run this migration"
             )
             return
 
-        if not space_used_by_directory(
-            "/var/lib/postgresql/9.6"
-        ) > free_space_in_directory("/var/lib/postgresql"):
+        # The cluster is upgraded with --link, so data files are hardlinked
+        # into the new cluster instead of being copied : we only need a small
+        # margin for the new catalog and WAL files
+        if (
+            free_space_in_directory("/var/lib/postgresql")
+            < space_used_by_directory("/var/lib/postgresql/9.6") / 10
+        ):
             raise YunohostValidationError(
                 "migration_0017_not_enough_space", path="/var/lib/postgresql/"
             )
 
-        self.runcmd("systemctl stop postgresql")
+        self.runcmd(["systemctl", "stop", "postgresql"])
         self.runcmd(
-            "LC_ALL=C pg_dropcluster --stop 11 main || true"
+            ["pg_dropcluster", "--stop", "11", "main"],
+            env_extra={"LC_ALL": "C"},
+            raise_on_errors=False,
         )  # We do not trigger an exception if the command fails because that probably means cluster 11 doesn't exists, which is fine because it's created during the pg_upgradecluster)
-        self.runcmd("LC_ALL=C pg_upgradecluster -m upgrade 9.6 main")
-        self.runcmd("LC_ALL=C pg_dropcluster --stop 9.6 main")
-        self.runcmd("systemctl start postgresql")
+        # N.B. : because of --link, the 9.6 and 11 clusters share the same
+        # data files once pg_upgrade has run, so the 9.6 cluster can't be
+        # started again afterwards and rolling back requires restoring a backup
+        self.runcmd(
+            ["pg_upgradecluster", "-m", "upgrade", "--link", "9.6", "main"],
+            env_extra={"LC_ALL": "C"},
+        )
+        self.runcmd(
+            ["pg_dropcluster", "--stop", "9.6", "main"], env_extra={"LC_ALL": "C"}
+        )
+        self.runcmd(["systemctl", "start", "postgresql"])
 
-    def package_is_installed(self, package_name):
+    def list_installed_packages(self):
 
-        (returncode, out, err) = self.runcmd(
-            "dpkg --list | grep '^ii ' | grep -q -w {}".format(package_name),
-            raise_on_errors=False,
+        out = subprocess.check_output(
+            ["dpkg-query", "-W", "-f=${Package}\t${Status}\n"], text=True
+        )
+        return frozenset(
+            package
+            for package, status in (line.split("\t", 1) for line in out.splitlines())
+            if status == "install ok installed"
         )
-        return returncode == 0
 
-    def runcmd(self, cmd, raise_on_errors=True):
+    def package_is_installed(self, package_name):
+
+        return package_name in self._installed_pkgs
+
+    def runcmd(self, cmd, env_extra=None, raise_on_errors=True):
 
-        logger.debug("Running command: " + cmd)
+        logger.debug("Running command: " + " ".join(cmd))
 
-        p = subprocess.Popen(
+        p = subprocess.run(
             cmd,
-            shell=True,
-            executable="/bin/bash",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            env={**os.environ, **(env_extra or {})},
+            capture_output=True,
         )
 
-        out, err = p.communicate()
+        out, err = p.stdout, p.stderr
         returncode = p.returncode
         if raise_on_errors and returncode != 0:
             raise YunohostError(
                 "Failed to run command '{}'.\nreturncode: {}\nstdout:\n{}\nstderr:\n{}\n".format(
-                    cmd, returncode, out, err
+                    " ".join(cmd), returncode, out, err
                 )
             )
 
-        out = out.strip().split("\n")
+        # N.B. : out is returned as a list of bytes lines, callers that care
+        # about the content have to decode it themselves
+        out = out.splitlines()
         return (returncode, out, err)
@@ -26,14 +26,18 @@
 import os
 import re
 import json
-import glob
+import time
 import base64
 import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 from moulinette import m18n
 from moulinette.core import MoulinetteError
 from moulinette.utils.log import getActionLogger
-from moulinette.utils.filesystem import write_to_file, read_file
+from moulinette.utils.filesystem import write_to_file
 from moulinette.utils.network import download_json
 
 from yunohost.utils.error import YunohostError, YunohostValidationError
@@ -44,22 +48,72 @@ from yunohost.regenconf import regen_conf
 
 logger = getActionLogger("yunohost.dyndns")
 
+DYNDNS_DIR = "/etc/yunohost/dyndns"
 DYNDNS_ZONE = "/etc/yunohost/dyndns/zone"
 
-RE_DYNDNS_PRIVATE_KEY_MD5 = re.compile(r".*/K(?P<domain>[^\s\+]+)\.\+157.+\.private$")
+# Matches the basename of private keys, either hmac-md5 (157) or hmac-sha512 (165)
+RE_DYNDNS_PRIVATE_KEY = re.compile(r"^K(?P<domain>[^\s\+]+)\.\+(?:157|165).+\.private$")
 
-RE_DYNDNS_PRIVATE_KEY_SHA512 = re.compile(
-    r".*/K(?P<domain>[^\s\+]+)\.\+165.+\.private$"
-)
+# provider -> (expiration timestamp, set of domains provided)
+_DYNDOMAINS_CACHE = {}
+DYNDOMAINS_CACHE_DURATION = 300  # 5 min
 
 
-def _dyndns_provides(provider, domain):
+def _fetch_json(url, session=None, expected_status_code=200):
+    """
+    Same as moulinette's download_json, but optionally going through a
+    requests.Session such that several requests reuse the same connection
+    """
+
+    if session is None:
+        return download_json(url, timeout=30, expected_status_code=expected_status_code)
+
+    try:
+        r = session.get(url, timeout=30)
+    except Exception as e:
+        raise MoulinetteError("Failed to request %s: %s" % (url, e), raw_msg=True)
+
+    if expected_status_code is not None and r.status_code != expected_status_code:
+        raise MoulinetteError(
+            "Request to %s failed with code %s: %s" % (url, r.status_code, r.text),
+            raw_msg=True,
+        )
+
+    try:
+        return r.json()
+    except ValueError as e:
+        raise MoulinetteError(
+            "Invalid json from %s: %s" % (url, e),
+            raw_msg=True,
+        )
+
+
+def _get_dyndomains(provider, session=None):
+    """
+    Fetch the list of domains provided by a dyndns provider, caching it
+    for a few minutes since it pretty much never changes
+    """
+
+    expiration, dyndomains = _DYNDOMAINS_CACHE.get(provider, (0, None))
+    if time.monotonic() < expiration:
+        return dyndomains
+
+    dyndomains = set(_fetch_json("https://%s/domains" % provider, session=session))
+    _DYNDOMAINS_CACHE[provider] = (
+        time.monotonic() + DYNDOMAINS_CACHE_DURATION,
+        dyndomains,
+    )
+    return dyndomains
+
+
+def _dyndns_provides(provider, domain, session=None):
     """
     Checks if a provider provide/manage a given domain.
 
     Keyword arguments:
         provider -- The url of the provider, e.g. "dyndns.yunohost.org"
         domain -- The full domain that you'd like.. e.g. "foo.nohost.me"
+        session -- Optional requests.Session to reuse the connection
 
     Returns:
         True if the provider provide/manages the domain. False otherwise.
@@ -68,9 +122,9 @@ def _dyndns_provides(provider, domain):
     logger.debug("Checking if %s is managed by %s ..." % (domain, provider))
 
     try:
-        # Dyndomains will be a list of domains supported by the provider
-        # e.g. [ "nohost.me", "noho.st" ]
-        dyndomains = download_json("https://%s/domains" % provider, timeout=30)
+        # Dyndomains will be a set of domains supported by the provider
+        # e.g. { "nohost.me", "noho.st" }
+        dyndomains = _get_dyndomains(provider, session=session)
     except MoulinetteError as e:
         logger.error(str(e))
         raise YunohostError(
@@ -83,13 +137,14 @@ def _dyndns_provides(provider, domain):
     return dyndomain in dyndomains
 
 
-def _dyndns_available(provider, domain):
+def _dyndns_available(provider, domain, session=None):
     """
     Checks if a domain is available from a given provider.
 
     Keyword arguments:
         provider -- The url of the provider, e.g. "dyndns.yunohost.org"
         domain -- The full domain that you'd like.. e.g. "foo.nohost.me"
+        session -- Optional requests.Session to reuse the connection
 
     Returns:
         True if the domain is available, False otherwise.
@@ -97,8 +152,10 @@ def _dyndns_available(provider, domain):
     logger.debug("Checking if domain %s is available on %s ..." % (domain, provider))
 
     try:
-        r = download_json(
-            "https://%s/test/%s" % (provider, domain), expected_status_code=None
+        r = _fetch_json(
+            "https://%s/test/%s" % (provider, domain),
+            session=session,
+            expected_status_code=None,
         )
     except MoulinetteError as e:
         logger.error(str(e))
@@ -143,47 +200,72 @@ def dyndns_subscribe(
     operation_logger.start()
 
     if key is None:
-        if len(glob.glob("/etc/yunohost/dyndns/*.key")) == 0:
-            if not os.path.exists("/etc/yunohost/dyndns"):
-                os.makedirs("/etc/yunohost/dyndns")
+        if not any(e.name.endswith(".key") for e in _dyndns_dir_entries()):
+            if not os.path.exists(DYNDNS_DIR):
+                os.makedirs(DYNDNS_DIR)
 
             logger.debug(m18n.n("dyndns_key_generating"))
 
-            os.system(
-                "cd /etc/yunohost/dyndns && "
-                "dnssec-keygen -a hmac-sha512 -b 512 -r /dev/urandom -n USER %s"
-                % domain
-            )
-            os.system(
-                "chmod 600 /etc/yunohost/dyndns/*.key /etc/yunohost/dyndns/*.private"
-            )
-
-        private_file = glob.glob("/etc/yunohost/dyndns/*%s*.private" % domain)[0]
-        key_file = glob.glob("/etc/yunohost/dyndns/*%s*.key" % domain)[0]
+            try:
+                subprocess.run(
+                    [
+                        "dnssec-keygen",
+                        "-a",
+                        "hmac-sha512",
+                        "-b",
+                        "512",
+                        "-r",
+                        "/dev/urandom",
+                        "-n",
+                        "USER",
+                        domain,
+                    ],
+                    cwd=DYNDNS_DIR,
+                    check=True,
+                )
+            except (OSError, subprocess.CalledProcessError) as e:
+                # Don't leave half-generated keys around
+                for entry in _dyndns_dir_entries():
+                    if entry.name.startswith("K%s." % domain):
+                        _rm_quiet(entry.path)
+                raise YunohostError(
+                    "dyndns_key_generation_failed", domain=domain, error=str(e)
+                )
+            for entry in _dyndns_dir_entries():
+                if entry.name.endswith((".key", ".private")):
+                    os.chmod(entry.path, 0o600)
+
+        entries = [e for e in _dyndns_dir_entries() if domain in e.name]
+        private_file = [e.path for e in entries if e.name.endswith(".private")][0]
+        key_file = [e.path for e in entries if e.name.endswith(".key")][0]
         with open(key_file) as f:
             key = f.readline().strip().split(" ", 6)[-1]
 
-    import requests  # lazy loading this module for performance reasons
-
     # Send subscription
+    request = urllib.request.Request(
+        "https://%s/key/%s?key_algo=hmac-sha512"
+        % (subscribe_host, base64.b64encode(key.encode()).decode()),
+        data=urllib.parse.urlencode({"subdomain": domain}).encode(),
+        method="POST",
+    )
     try:
-        r = requests.post(
-            "https://%s/key/%s?key_algo=hmac-sha512"
-            % (subscribe_host, base64.b64encode(key.encode()).decode()),
-            data={"subdomain": domain},
-            timeout=30,
-        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as r:
+                status_code, text = r.status, r.read().decode()
+        except urllib.error.HTTPError as e:
+            # Non-2xx answers still carry the error message from dynette
+            status_code, text = e.code, e.read().decode()
     except Exception as e:
-        os.system("rm -f %s" % private_file)
-        os.system("rm -f %s" % key_file)
+        _rm_quiet(private_file)
+        _rm_quiet(key_file)
         raise YunohostError("dyndns_registration_failed", error=str(e))
-    if r.status_code != 201:
-        os.system("rm -f %s" % private_file)
-        os.system("rm -f %s" % key_file)
+    if status_code != 201:
+        _rm_quiet(private_file)
+        _rm_quiet(key_file)
         try:
-            error = json.loads(r.text)["error"]
+            error = json.loads(text)["error"]
         except Exception:
-            error = 'Server error, code: %s. (Message: "%s")' % (r.status_code, r.text)
+            error = 'Server error, code: %s. (Message: "%s")' % (status_code, text)
         raise YunohostError("dyndns_registration_failed", error=error)
 
     # Yunohost regen conf will add the dyndns cron job if a private key exists
@@ -192,12 +274,7 @@ def dyndns_subscribe(
 
     # Add some dyndns update in 2 and 4 minutes from now such that user should
     # not have to wait 10ish minutes for the conf to propagate
-    cmd = (
-        "at -M now + {t} >/dev/null 2>&1 <<< \"/bin/bash -c 'yunohost dyndns update'\""
-    )
-    # For some reason subprocess doesn't like the redirections so we have to use bash -c explicity...
-    subprocess.check_call(["bash", "-c", cmd.format(t="2 min")])
-    subprocess.check_call(["bash", "-c", cmd.format(t="4 min")])
+    _schedule_deferred_updates(minutes=[2, 4])
 
     logger.success(m18n.n("dyndns_registered"))
 
@@ -238,7 +315,11 @@ def dyndns_update(
     # If key is not given, pick the first file we find with the domain given
     else:
         if key is None:
-            keys = glob.glob("/etc/yunohost/dyndns/K{0}.+*.private".format(domain))
+            keys = [
+                e.path
+                for e in _dyndns_dir_entries()
+                if e.name.startswith("K%s.+" % domain) and e.name.endswith(".private")
+            ]
 
             if not keys:
                 raise YunohostValidationError("dyndns_key_not_found")
@@ -256,13 +337,14 @@ def dyndns_update(
         "zone %s" % host,
     ]
 
-    def resolve_domain(domain, rdtype):
+    # Resolve the dynette IP once, it's used for both the A and AAAA lookups
+    # FIXME make this work for IPv6-only hosts too..
+    ok, result = dig(dyn_host, "A")
+    dyn_host_ip = result[0] if ok == "ok" and len(result) else None
+    if not dyn_host_ip:
+        raise YunohostError("Failed to resolve %s" % dyn_host, raw_msg=True)
 
-        # FIXME make this work for IPv6-only hosts too..
-        ok, result = dig(dyn_host, "A")
-        dyn_host_ip = result[0] if ok == "ok" and len(result) else None
-        if not dyn_host_ip:
-            raise YunohostError("Failed to resolve %s" % dyn_host, raw_msg=True)
+    def resolve_domain(domain, rdtype):
 
         ok, result = dig(domain, rdtype, resolvers=[dyn_host_ip])
         if ok == "ok":
@@ -291,18 +373,23 @@ def dyndns_update(
             "Failed to resolve %s for %s" % (rdtype, domain), raw_msg=True
         )
 
-    old_ipv4 = resolve_domain(domain, "A")
-    old_ipv6 = resolve_domain(domain, "AAAA")
+    # Those are independent network requests, so run them concurrently
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        old_ipv4 = executor.submit(resolve_domain, domain, "A")
+        old_ipv6 = executor.submit(resolve_domain, domain, "AAAA")
+
+        # Get current IPv4 and IPv6, unless they were explicitly provided
+        # (get_public_ip already keeps them in a short-lived on-disk cache)
+        ipv4_ = executor.submit(get_public_ip) if ipv4 is None else None
+        ipv6_ = executor.submit(get_public_ip, 6) if ipv6 is None else None
 
-    # Get current IPv4 and IPv6
-    ipv4_ = get_public_ip()
-    ipv6_ = get_public_ip(6)
+        old_ipv4, old_ipv6 = old_ipv4.result(), old_ipv6.result()
 
-    if ipv4 is None:
-        ipv4 = ipv4_
+        if ipv4 is None:
+            ipv4 = ipv4_.result()
 
-    if ipv6 is None:
-        ipv6 = ipv6_
+        if ipv6 is None:
+            ipv6 = ipv6_.result()
 
     logger.debug("Old IPv4/v6 are (%s, %s)" % (old_ipv4, old_ipv6))
     logger.debug("Requested IPv4/v6 are (%s, %s)" % (ipv4, ipv6))
@@ -320,56 +407,53 @@ def dyndns_update(
 
     # Delete custom DNS records, we don't support them (have to explicitly
     # authorize them on dynette)
-    for category in dns_conf.keys():
-        if category not in ["basic", "mail", "xmpp", "extra"]:
-            del dns_conf[category]
-
-    # Delete the old records for all domain/subdomains
+    dns_conf = {
+        category: dns_conf[category]
+        for category in ["basic", "mail", "xmpp", "extra"]
+        if category in dns_conf
+    }
+
+    def full_value(value):
+        # (For some reason) here we want the format with everytime the
+        # entire, full domain shown explicitly, not just "muc" or "@", it
+        # should be muc.the.domain.tld. or the.domain.tld
+        return (domain if value == "@" else value).replace(";", r"\;")
+
+    # Delete the old records and add the new ones for all domain/subdomains,
+    # in a single pass over the records. All deletions must still come before
+    # all additions : "update delete foo.tld." removes every record of that
+    # name, including the ones that would have been added just before.
+    delete_lines, add_lines = [], []
 
     # every dns_conf.values() is a list of :
     # [{"name": "...", "ttl": "...", "type": "...", "value": "..."}]
     for records in dns_conf.values():
-        for record in records:
-            action = "update delete {name}.{domain}.".format(domain=domain, **record)
-            action = action.replace(" @.", " ")
-            lines.append(action)
-
-    # Add the new records for all domain/subdomains
-
-    for records in dns_conf.values():
-        for record in records:
-            # (For some reason) here we want the format with everytime the
-            # entire, full domain shown explicitly, not just "muc" or "@", it
-            # should be muc.the.domain.tld. or the.domain.tld
-            if record["value"] == "@":
-                record["value"] = domain
-            record["value"] = record["value"].replace(";", r"\;")
-
-            action = "update add {name}.{domain}. {ttl} {type} {value}".format(
-                domain=domain, **record
+        for r in records:
+            delete_lines.append(f"update delete {r['name']}.{domain}.")
+            add_lines.append(
+                f"update add {r['name']}.{domain}. {r['ttl']} {r['type']} {full_value(r['value'])}"
             )
-            action = action.replace(" @.", " ")
-            lines.append(action)
 
-    lines += ["show", "send"]
+    lines += [*delete_lines, *add_lines, "show", "send"]
+
+    zone_update = "\n".join(lines).replace(" @.", " ") + "\n"
 
-    # Write the actions to do to update to a file, to be able to pass it
-    # to nsupdate as argument
-    write_to_file(DYNDNS_ZONE, "\n".join(lines))
+    # Keep a copy of the actions on disk for debugging purposes, but feed them
+    # to nsupdate through its stdin such that it doesn't have to re-read them
+    write_to_file(DYNDNS_ZONE, zone_update)
 
     logger.debug("Now pushing new conf to DynDNS host...")
 
     if not dry_run:
         try:
-            command = ["/usr/bin/nsupdate", "-k", key, DYNDNS_ZONE]
-            subprocess.check_call(command)
+            command = ["/usr/bin/nsupdate", "-k", key]
+            subprocess.run(command, input=zone_update.encode(), check=True)
         except subprocess.CalledProcessError:
             raise YunohostError("dyndns_ip_update_failed")
 
         logger.success(m18n.n("dyndns_ip_updated"))
     else:
-        print(read_file(DYNDNS_ZONE))
-        print("")
+        print(zone_update)
         print(
             "Warning: dry run, this is only the generated config, it won't be applied"
         )
@@ -387,6 +471,47 @@ def dyndns_removecron():
     )
 
 
+def _dyndns_dir_entries():
+    """
+    List the entries of the dyndns directory (keys, zone file) with a single
+    directory read, so that callers can filter them without re-globbing
+    """
+
+    if not os.path.isdir(DYNDNS_DIR):
+        return []
+
+    with os.scandir(DYNDNS_DIR) as it:
+        return list(it)
+
+
+def _schedule_deferred_updates(minutes):
+    """
+    Schedule a 'yunohost dyndns update' run in each of the given numbers of
+    minutes from now (as transient systemd timers, so that they run as fresh
+    commands, taking the moulinette lock, and not as part of this one)
+    """
+
+    for delay in minutes:
+        subprocess.run(
+            [
+                "systemd-run",
+                "--quiet",
+                "--on-active=%smin" % delay,
+                "/usr/bin/yunohost",
+                "dyndns",
+                "update",
+            ],
+            check=True,
+        )
+
+
+def _rm_quiet(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
 def _guess_current_dyndns_domain(dyn_host):
     """
     This function tries to guess which domain should be updated by
@@ -397,22 +522,32 @@ def _guess_current_dyndns_domain(dyn_host):
     """
 
     # Retrieve the first registered domain
-    paths = list(glob.iglob("/etc/yunohost/dyndns/K*.private"))
-    for path in paths:
-        match = RE_DYNDNS_PRIVATE_KEY_MD5.match(path)
-        if not match:
-            match = RE_DYNDNS_PRIVATE_KEY_SHA512.match(path)
-            if not match:
-                continue
-        _domain = match.group("domain")
-
-        # Verify if domain is registered (i.e., if it's available, skip
-        # current domain beause that's not the one we want to update..)
-        # If there's only 1 such key found, then avoid doing the request
-        # for nothing (that's very probably the one we want to find ...)
-        if len(paths) > 1 and _dyndns_available(dyn_host, _domain):
-            continue
-        else:
-            return (_domain, path)
+    entries = [
+        e
+        for e in _dyndns_dir_entries()
+        if e.name.startswith("K") and e.name.endswith(".private")
+    ]
+    candidates = []
+    for entry in entries:
+        match = RE_DYNDNS_PRIVATE_KEY.match(entry.name)
+        if match:
+            candidates.append((match.group("domain"), entry.path))
+
+    # If there's only 1 such key found, then avoid doing the request
+    # for nothing (that's very probably the one we want to find ...)
+    if len(entries) <= 1:
+        return candidates[0] if candidates else (None, None)
+
+    # Verify if domains are registered (i.e., if it's available, skip
+    # current domain beause that's not the one we want to update..)
+    # The checks are independent requests to the dynette, so run them
+    # concurrently, but still pick the first registered domain in order
+    with ThreadPoolExecutor(max_workers=min(8, len(candidates) or 1)) as executor:
+        availabilities = executor.map(
+            lambda c: _dyndns_available(dyn_host, c[0]), candidates
+        )
+        for candidate, available in zip(candidates, availabilities):
+            if not available:
+                return candidate
 
     return (None, None)
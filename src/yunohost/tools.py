@@ -26,28 +26,26 @@
 import re
 import os
 import yaml
+import shlex
+import shutil
 import subprocess
 import pwd
+import stat
 import time
+import tempfile
+from functools import lru_cache
 from importlib import import_module
+from bisect import bisect_right
+from itertools import chain
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from packaging import version
 
 from moulinette import msignals, m18n
 from moulinette.utils.log import getActionLogger
 from moulinette.utils.process import check_output, call_async_output
-from moulinette.utils.filesystem import read_yaml, write_to_yaml
+from moulinette.utils.filesystem import read_yaml
 
-from yunohost.app import (
-    _update_apps_catalog,
-    app_info,
-    app_upgrade,
-    _initialize_apps_catalog_system,
-)
-from yunohost.domain import domain_add
-from yunohost.dyndns import _dyndns_available, _dyndns_provides
-from yunohost.firewall import firewall_upnp
-from yunohost.service import service_start, service_enable
-from yunohost.regenconf import regen_conf
 from yunohost.utils.packages import (
     _dump_sources_list,
     _list_upgradable_apt_packages,
@@ -59,9 +57,18 @@ from yunohost.log import is_unit_operation, OperationLogger
 # FIXME this is a duplicate from apps.py
 APPS_SETTING_PATH = "/etc/yunohost/apps/"
 MIGRATIONS_STATE_PATH = "/etc/yunohost/migrations.yaml"
+_MIGRATION_FILE_RE = re.compile(r"^\d+_(?P<name>[a-zA-Z0-9_]+)\.py$")
+# ((mtime, size) of the state file, parsed content), cf tools_migrations_state
+_MIGRATIONS_STATE_CACHE = None
 
 logger = getActionLogger("yunohost.tools")
 
+# Filters for the apt / dpkg output lines we don't want to show as warnings
+_is_boring_apt_message = re.compile(r"apt does not have a stable CLI interface").search
+_is_irrelevant_dpkg_message = re.compile(
+    r"service sudo-ldap already provided|Reading database \.\.\."
+).search
+
 
 def tools_versions():
     return ynh_packages_version()
@@ -72,39 +79,28 @@ def tools_ldapinit():
     YunoHost LDAP initialization
     """
 
+    # Use libyaml's loader when available, it's way faster than the pure
+    # python one (and the scheme doesn't need anything but the safe loader)
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     with open("/usr/share/yunohost/yunohost-config/moulinette/ldap_scheme.yml") as f:
-        ldap_map = yaml.load(f)
+        ldap_map = yaml.load(f, Loader=loader)
 
-    from yunohost.utils.ldap import _get_ldap_interface
+    from yunohost.utils.ldap import _get_ldap_interface, _ldap_add_many
 
     ldap = _get_ldap_interface()
 
-    for rdn, attr_dict in ldap_map["parents"].items():
-        try:
-            ldap.add(rdn, attr_dict)
-        except Exception as e:
-            logger.warn(
-                "Error when trying to inject '%s' -> '%s' into ldap: %s"
-                % (rdn, attr_dict, e)
-            )
-
-    for rdn, attr_dict in ldap_map["children"].items():
-        try:
-            ldap.add(rdn, attr_dict)
-        except Exception as e:
-            logger.warn(
-                "Error when trying to inject '%s' -> '%s' into ldap: %s"
-                % (rdn, attr_dict, e)
-            )
-
-    for rdn, attr_dict in ldap_map["depends_children"].items():
-        try:
-            ldap.add(rdn, attr_dict)
-        except Exception as e:
-            logger.warn(
-                "Error when trying to inject '%s' -> '%s' into ldap: %s"
-                % (rdn, attr_dict, e)
-            )
+    # Entries of each level are added in one batch, but a level has to be
+    # completed before the next one since children depend on their parents
+    # (the batches are lazily chained, so they still run one after the other)
+    levels = ["parents", "children", "depends_children"]
+    failures = chain.from_iterable(
+        _ldap_add_many(ldap_map[level].items()) for level in levels
+    )
+    for rdn, attr_dict, e in failures:
+        logger.warn(
+            "Error when trying to inject '%s' -> '%s' into ldap: %s"
+            % (rdn, attr_dict, e)
+        )
 
     admin_dict = {
         "cn": ["admin"],
@@ -121,7 +117,7 @@ def tools_ldapinit():
     ldap.update("cn=admin", admin_dict)
 
     # Force nscd to refresh cache to take admin creation into account
-    subprocess.call(["nscd", "-i", "passwd"])
+    _nscd_invalidate("passwd")
 
     # Check admin actually exists now
     try:
@@ -150,7 +146,6 @@ def tools_adminpw(new_password, check_strength=True):
     """
     from yunohost.user import _hash_user_password
     from yunohost.utils.password import assert_password_is_strong_enough
-    import spwd
 
     if check_strength:
         assert_password_is_strong_enough("admin", new_password)
@@ -179,20 +174,9 @@ def tools_adminpw(new_password, check_strength=True):
     else:
         # Write as root password
         try:
-            hash_root = spwd.getspnam("root").sp_pwd
-
-            with open("/etc/shadow", "r") as before_file:
-                before = before_file.read()
-
-            with open("/etc/shadow", "w") as after_file:
-                after_file.write(
-                    before.replace(
-                        "root:" + hash_root, "root:" + new_hash.replace("{CRYPT}", "")
-                    )
-                )
-        # An IOError may be thrown if for some reason we can't read/write /etc/passwd
-        # A KeyError could also be thrown if 'root' is not in /etc/passwd in the first place (for example because no password defined ?)
-        # (c.f. the line about getspnam)
+            _set_root_password_hash(new_hash.replace("{CRYPT}", ""))
+        # An IOError may be thrown if for some reason we can't read/write /etc/shadow
+        # A KeyError could also be thrown if 'root' is not in /etc/shadow in the first place (for example because no password defined ?)
         except (IOError, KeyError):
             logger.warning(m18n.n("root_password_desynchronized"))
             return
@@ -201,6 +185,45 @@ def tools_adminpw(new_password, check_strength=True):
         logger.success(m18n.n("admin_password_changed"))
 
 
+def _set_root_password_hash(new_hash):
+    """
+    Replace the password hash of root in /etc/shadow
+
+    The file is rewritten line by line to a temporary file which then
+    atomically replaces /etc/shadow, such that a crash can't leave a
+    truncated shadow file behind.
+    """
+
+    shadow_stat = os.stat("/etc/shadow")
+    replaced = False
+
+    with open("/etc/shadow", "r") as before_file, tempfile.NamedTemporaryFile(
+        "w", dir="/etc", prefix=".shadow", delete=False
+    ) as after_file:
+        try:
+            os.chown(after_file.name, shadow_stat.st_uid, shadow_stat.st_gid)
+            os.chmod(after_file.name, stat.S_IMODE(shadow_stat.st_mode))
+            for line in before_file:
+                if line.startswith("root:"):
+                    fields = line.split(":")
+                    fields[1] = new_hash
+                    line = ":".join(fields)
+                    replaced = True
+                after_file.write(line)
+            # Make sure the new content is on disk before it replaces the old one
+            after_file.flush()
+            os.fsync(after_file.fileno())
+        except Exception:
+            os.remove(after_file.name)
+            raise
+
+    if not replaced:
+        os.remove(after_file.name)
+        raise KeyError("root")
+
+    os.rename(after_file.name, "/etc/shadow")
+
+
 def tools_maindomain(new_main_domain=None):
     from yunohost.domain import domain_main_domain
 
@@ -217,16 +240,37 @@ def tools_maindomain(new_main_domain=None):
 
 def _set_hostname(hostname, pretty_hostname=None):
     """
-    Change the machine hostname using hostnamectl
+    Change the machine hostname using systemd-hostnamed (through dbus, or
+    hostnamectl if that fails)
     """
 
     if not pretty_hostname:
         pretty_hostname = "(YunoHost/%s)" % hostname
 
     # First clear nsswitch cache for hosts to make sure hostname is resolved...
-    subprocess.call(["nscd", "-i", "hosts"])
+    _nscd_invalidate("hosts")
+
+    # Talk to hostnamed directly, that's what hostnamectl does anyway
+    try:
+        import dbus
 
-    # Then call hostnamectl
+        bus = dbus.SystemBus()
+        hostnamed = bus.get_object(
+            "org.freedesktop.hostname1", "/org/freedesktop/hostname1"
+        )
+        interface = dbus.Interface(hostnamed, "org.freedesktop.hostname1")
+        # (The second argument is 'interactive', i.e. whether polkit may
+        # prompt for authorization, we don't want that)
+        interface.SetStaticHostname(hostname, False)
+        interface.SetHostname(hostname, False)
+        interface.SetPrettyHostname(pretty_hostname, False)
+        return
+    except Exception as e:
+        logger.debug(
+            "Failed to set hostname through dbus, falling back to hostnamectl: %s" % e
+        )
+
+    # Otherwise call hostnamectl
     commands = [
         "hostnamectl --static    set-hostname".split() + [hostname],
         "hostnamectl --transient set-hostname".split() + [hostname],
@@ -246,6 +290,39 @@ def _set_hostname(hostname, pretty_hostname=None):
             logger.debug(out)
 
 
+def _nscd_invalidate(db):
+    """
+    Flush one of nscd's caches (passwd, group, hosts, ...), same as
+    'nscd -i <db>' but talking to the daemon's socket directly
+
+    Does nothing if nscd isn't running
+    """
+
+    import socket
+    import struct
+
+    NSCD_SOCKET = "/var/run/nscd/socket"
+    NSCD_VERSION = 2
+    INVALIDATE = 10
+
+    if not os.path.exists(NSCD_SOCKET):
+        return
+
+    # Request header is (version, type, key length), the key being the
+    # NUL-terminated name of the database (cf nscd/nscd-client.h)
+    key = db.encode() + b"\0"
+    request = struct.pack("iii", NSCD_VERSION, INVALIDATE, len(key)) + key
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(5)
+            s.connect(NSCD_SOCKET)
+            s.sendall(request)
+            s.recv(4)
+    except OSError as e:
+        logger.debug("Failed to invalidate nscd's %s cache: %s" % (db, e))
+
+
 def _detect_virt():
     """
     Returns the output of systemd-detect-virt (so e.g. 'none' or 'lxc' or ...)
@@ -279,8 +356,13 @@ def tools_postinstall(
         password -- YunoHost admin password
 
     """
+    from yunohost.app import _initialize_apps_catalog_system, _update_apps_catalog
     from yunohost.utils.password import assert_password_is_strong_enough
-    from yunohost.domain import domain_main_domain
+    from yunohost.domain import domain_add, domain_main_domain
+    from yunohost.dyndns import _dyndns_provides, _dyndns_available
+    from yunohost.firewall import firewall_upnp
+    from yunohost.service import service_start, service_enable
+    from yunohost.regenconf import regen_conf
     import psutil
 
     dyndns_provider = "dyndns.yunohost.org"
@@ -296,10 +378,10 @@ def tools_postinstall(
         )
 
     # Check there's at least 10 GB on the rootfs...
-    disk_partitions = sorted(psutil.disk_partitions(), key=lambda k: k.mountpoint)
-    main_disk_partitions = [d for d in disk_partitions if d.mountpoint in ["/", "/var"]]
     main_space = sum(
-        [psutil.disk_usage(d.mountpoint).total for d in main_disk_partitions]
+        psutil.disk_usage(d.mountpoint).total
+        for d in psutil.disk_partitions()
+        if d.mountpoint in {"/", "/var"}
     )
     GB = 1024 ** 3
     if not force_diskspace and main_space < 10 * GB:
@@ -310,36 +392,50 @@ def tools_postinstall(
         assert_password_is_strong_enough("admin", password)
 
     if not ignore_dyndns:
-        # Check if yunohost dyndns can handle the given domain
-        # (i.e. is it a .nohost.me ? a .noho.st ?)
-        try:
-            is_nohostme_or_nohost = _dyndns_provides(dyndns_provider, domain)
-        # If an exception is thrown, most likely we don't have internet
-        # connectivity or something. Assume that this domain isn't manageable
-        # and inform the user that we could not contact the dyndns host server.
-        except Exception:
-            logger.warning(
-                m18n.n("dyndns_provider_unreachable", provider=dyndns_provider)
-            )
-            is_nohostme_or_nohost = False
+        import requests  # lazy loading this module for performance reasons
 
-        # If this is a nohost.me/noho.st, actually check for availability
-        if is_nohostme_or_nohost:
-            # (Except if the user explicitly said he/she doesn't care about dyndns)
-            if ignore_dyndns:
-                dyndns = False
-            # Check if the domain is available...
-            elif _dyndns_available(dyndns_provider, domain):
-                dyndns = True
-            # If not, abort the postinstall
+        # Both checks below go through the same HTTPS connection
+        with requests.Session() as session:
+            # Check if yunohost dyndns can handle the given domain
+            # (i.e. is it a .nohost.me ? a .noho.st ?)
+            try:
+                is_nohostme_or_nohost = _dyndns_provides(
+                    dyndns_provider, domain, session=session
+                )
+            # If an exception is thrown, most likely we don't have internet
+            # connectivity or something. Assume that this domain isn't manageable
+            # and inform the user that we could not contact the dyndns host server.
+            except Exception:
+                logger.warning(
+                    m18n.n("dyndns_provider_unreachable", provider=dyndns_provider)
+                )
+                is_nohostme_or_nohost = False
+
+            # If this is a nohost.me/noho.st, actually check for availability
+            if is_nohostme_or_nohost:
+                # (Except if the user explicitly said he/she doesn't care about dyndns)
+                if ignore_dyndns:
+                    dyndns = False
+                # Check if the domain is available...
+                elif _dyndns_available(dyndns_provider, domain, session=session):
+                    dyndns = True
+                # If not, abort the postinstall
+                else:
+                    raise YunohostValidationError("dyndns_unavailable", domain=domain)
             else:
-                raise YunohostValidationError("dyndns_unavailable", domain=domain)
-        else:
-            dyndns = False
+                dyndns = False
     else:
         dyndns = False
 
-    if os.system("iptables -V >/dev/null 2>/dev/null") != 0:
+    try:
+        iptables_check = subprocess.run(
+            ["iptables", "-V"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        iptables_works = iptables_check.returncode == 0
+    except FileNotFoundError:
+        iptables_works = False
+
+    if not iptables_works:
         raise YunohostValidationError(
             "iptables/nftables does not seems to be working on your setup. You may be in a container or your kernel does have the proper modules loaded. Sometimes, rebooting the machine may solve the issue.",
             raw_msg=True,
@@ -353,7 +449,8 @@ def tools_postinstall(
     domain_main_domain(domain)
 
     # Change LDAP admin password
-    tools_adminpw(password, check_strength=not force_password)
+    # (its strength has already been checked at the beginning, if needed)
+    tools_adminpw(password, check_strength=False)
 
     # Enable UPnP silently and reload firewall
     firewall_upnp("enable", no_refresh=True)
@@ -372,7 +469,7 @@ def tools_postinstall(
     # Init migrations (skip them, no need to run them on a fresh system)
     _skip_all_migrations()
 
-    os.system("touch /etc/yunohost/installed")
+    open("/etc/yunohost/installed", "a").close()
 
     # Enable and start YunoHost firewall at boot time
     service_enable("yunohost-firewall")
@@ -403,6 +500,8 @@ def tools_postinstall(
 def tools_regen_conf(
     names=[], with_diff=False, force=False, dry_run=False, list_pending=False
 ):
+    from yunohost.regenconf import regen_conf
+
     return regen_conf(names, with_diff, force, dry_run, list_pending)
 
 
@@ -410,6 +509,7 @@ def tools_update(target=None, apps=False, system=False):
     """
     Update apps & system package cache
     """
+    from yunohost.app import _update_apps_catalog
 
     # Legacy options (--system, --apps)
     if apps or system:
@@ -444,22 +544,21 @@ def tools_update(target=None, apps=False, system=False):
         warnings = []
 
         def is_legit_warning(m):
-            legit_warning = (
-                m.rstrip()
-                and "apt does not have a stable CLI interface" not in m.rstrip()
-            )
+            legit_warning = bool(m) and not _is_boring_apt_message(m)
             if legit_warning:
                 warnings.append(m)
             return legit_warning
 
-        callbacks = (
+        def on_stdout(line):
             # stdout goes to debug
-            lambda l: logger.debug(l.rstrip()),
+            logger.debug(line.rstrip())
+
+        def on_stderr(line):
             # stderr goes to warning except for the boring apt messages
-            lambda l: logger.warning(l.rstrip())
-            if is_legit_warning(l)
-            else logger.debug(l.rstrip()),
-        )
+            line = line.rstrip()
+            (logger.warning if is_legit_warning(line) else logger.debug)(line)
+
+        callbacks = (on_stdout, on_stderr)
 
         logger.info(m18n.n("updating_apt_cache"))
 
@@ -496,6 +595,7 @@ def tools_update(target=None, apps=False, system=False):
 
 
 def _list_upgradable_apps():
+    from yunohost.app import app_info
 
     app_list_installed = os.listdir(APPS_SETTING_PATH)
     for app_id in app_list_installed:
@@ -541,7 +641,8 @@ def tools_upgrade(
        apps -- List of apps to upgrade (or [] to update all apps)
        system -- True to upgrade system
     """
-    from yunohost.utils import packages
+    from yunohost.app import app_upgrade
+    from yunohost.utils import packages, selfupgrade
 
     if packages.dpkg_is_broken():
         raise YunohostValidationError("dpkg_is_broken")
@@ -601,35 +702,40 @@ def tools_upgrade(
 
     if target == "system":
 
+        # Critical packages are packages that we can't just upgrade
+        # randomly from yunohost itself... upgrading them is likely to
+        critical_packages = ["moulinette", "yunohost", "yunohost-admin", "ssowat"]
+        critical_set = set(critical_packages)
+
+        critical_packages_upgradable = []
+        noncritical_packages_upgradable = []
+        for p in _list_upgradable_apt_packages():
+            if p["name"] in critical_set:
+                critical_packages_upgradable.append(p["name"])
+            else:
+                noncritical_packages_upgradable.append(p["name"])
+
         # Check that there's indeed some packages to upgrade
-        upgradables = list(_list_upgradable_apt_packages())
-        if not upgradables:
+        if not critical_packages_upgradable and not noncritical_packages_upgradable:
             logger.info(m18n.n("already_up_to_date"))
 
         logger.info(m18n.n("upgrading_packages"))
         operation_logger.start()
 
-        # Critical packages are packages that we can't just upgrade
-        # randomly from yunohost itself... upgrading them is likely to
-        critical_packages = ["moulinette", "yunohost", "yunohost-admin", "ssowat"]
-
-        critical_packages_upgradable = [
-            p["name"] for p in upgradables if p["name"] in critical_packages
-        ]
-        noncritical_packages_upgradable = [
-            p["name"] for p in upgradables if p["name"] not in critical_packages
-        ]
-
         # Prepare dist-upgrade command
-        dist_upgrade = "DEBIAN_FRONTEND=noninteractive"
-        dist_upgrade += " APT_LISTCHANGES_FRONTEND=none"
-        dist_upgrade += " apt-get"
-        dist_upgrade += (
-            " --fix-broken --show-upgraded --assume-yes --quiet -o=Dpkg::Use-Pty=0"
+        dist_upgrade = " ".join(
+            [
+                "DEBIAN_FRONTEND=noninteractive",
+                "APT_LISTCHANGES_FRONTEND=none",
+                "apt-get",
+                "--fix-broken --show-upgraded --assume-yes --quiet -o=Dpkg::Use-Pty=0",
+                *(
+                    '-o Dpkg::Options::="--force-conf{}"'.format(conf_flag)
+                    for conf_flag in ["old", "miss", "def"]
+                ),
+                "dist-upgrade",
+            ]
         )
-        for conf_flag in ["old", "miss", "def"]:
-            dist_upgrade += ' -o Dpkg::Options::="--force-conf{}"'.format(conf_flag)
-        dist_upgrade += " dist-upgrade"
 
         #
         # "Regular" packages upgrade
@@ -639,12 +745,13 @@ def tools_upgrade(
             logger.info(m18n.n("tools_upgrade_regular_packages"))
 
             # Mark all critical packages as held
-            for package in critical_packages:
-                check_output("apt-mark hold %s" % package)
+            check_output(["apt-mark", "hold"] + critical_packages, shell=False)
 
             # Doublecheck with apt-mark showhold that packages are indeed held ...
-            held_packages = check_output("apt-mark showhold").split("\n")
-            if any(p not in held_packages for p in critical_packages):
+            held_packages = set(
+                check_output(["apt-mark", "showhold"], shell=False).split()
+            )
+            if not critical_set.issubset(held_packages):
                 logger.warning(m18n.n("tools_upgrade_cant_hold_critical_packages"))
                 operation_logger.error(m18n.n("packages_upgrade_failed"))
                 raise YunohostError(m18n.n("packages_upgrade_failed"))
@@ -652,25 +759,26 @@ def tools_upgrade(
             logger.debug("Running apt command :\n{}".format(dist_upgrade))
 
             def is_relevant(line):
-                irrelevants = [
-                    "service sudo-ldap already provided",
-                    "Reading database ...",
-                ]
-                return all(i not in line.rstrip() for i in irrelevants)
-
-            callbacks = (
-                lambda l: logger.info("+ " + l.rstrip() + "\r")
-                if is_relevant(l)
-                else logger.debug(l.rstrip() + "\r"),
-                lambda l: logger.warning(l.rstrip())
-                if is_relevant(l)
-                else logger.debug(l.rstrip()),
-            )
+                return not _is_irrelevant_dpkg_message(line)
+
+            def on_stdout(line):
+                line = line.rstrip()
+                if is_relevant(line):
+                    logger.info("+ " + line + "\r")
+                else:
+                    logger.debug(line + "\r")
+
+            def on_stderr(line):
+                line = line.rstrip()
+                (logger.warning if is_relevant(line) else logger.debug)(line)
+
+            callbacks = (on_stdout, on_stderr)
             returncode = call_async_output(dist_upgrade, callbacks, shell=True)
             if returncode != 0:
-                upgradables = list(_list_upgradable_apt_packages())
                 noncritical_packages_upgradable = [
-                    p["name"] for p in upgradables if p["name"] not in critical_packages
+                    p["name"]
+                    for p in _list_upgradable_apt_packages()
+                    if p["name"] not in critical_set
                 ]
                 logger.warning(
                     m18n.n(
@@ -689,12 +797,13 @@ def tools_upgrade(
             logger.info(m18n.n("tools_upgrade_special_packages"))
 
             # Mark all critical packages as unheld
-            for package in critical_packages:
-                check_output("apt-mark unhold %s" % package)
+            check_output(["apt-mark", "unhold"] + critical_packages, shell=False)
 
             # Doublecheck with apt-mark showhold that packages are indeed unheld ...
-            held_packages = check_output("apt-mark showhold").split("\n")
-            if any(p in held_packages for p in critical_packages):
+            held_packages = set(
+                check_output(["apt-mark", "showhold"], shell=False).split()
+            )
+            if held_packages & critical_set:
                 logger.warning(m18n.n("tools_upgrade_cant_unhold_critical_packages"))
                 operation_logger.error(m18n.n("packages_upgrade_failed"))
                 raise YunohostError(m18n.n("packages_upgrade_failed"))
@@ -707,55 +816,48 @@ def tools_upgrade(
             # likely to kill/restart the api which is in turn likely to kill this
             # command before it ends...)
             #
-            logfile = operation_logger.log_path
-            dist_upgrade = dist_upgrade + " 2>&1 | tee -a {}".format(logfile)
-
             MOULINETTE_LOCK = "/var/run/moulinette_yunohost.lock"
-            wait_until_end_of_yunohost_command = (
-                "(while [ -f {} ]; do sleep 2; done)".format(MOULINETTE_LOCK)
-            )
-            mark_success = (
-                "(echo 'Done!' | tee -a {} && echo 'success: true' >> {})".format(
-                    logfile, operation_logger.md_path
-                )
-            )
-            mark_failure = (
-                "(echo 'Failed :(' | tee -a {} && echo 'success: false' >> {})".format(
-                    logfile, operation_logger.md_path
-                )
-            )
-            update_log_metadata = "sed -i \"s/ended_at: .*$/ended_at: $(date -u +'%Y-%m-%d %H:%M:%S.%N')/\" {}"
-            update_log_metadata = update_log_metadata.format(operation_logger.md_path)
 
             # Dirty hack such that the operation_logger does not add ended_at
             # and success keys in the log metadata.  (c.f. the code of the
             # is_unit_operation + operation_logger.close()) We take care of
-            # this ourselves (c.f. the mark_success and updated_log_metadata in
-            # the huge command launched by os.system)
+            # this ourselves (c.f. update_log_metadata in the selfupgrade helper)
             operation_logger.ended_at = "notyet"
 
+            # The helper waits for the current command to end, runs the
+            # upgrade while copying its output to the log, then updates the
+            # log metadata. It is run from a copy because the upgrade is going
+            # to replace the original file (and it removes this copy itself).
+            # mkstemp creates the copy with a random name, exclusively and
+            # readable by root only, so nobody else can tamper with it.
+            fd, helper_path = tempfile.mkstemp(
+                prefix="yunohost-selfupgrade-", suffix=".py"
+            )
+            with os.fdopen(fd, "wb") as helper, open(selfupgrade.__file__, "rb") as f:
+                shutil.copyfileobj(f, helper)
+
             upgrade_completed = "\n" + m18n.n(
                 "tools_upgrade_special_packages_completed"
             )
-            command = "({wait} && {dist_upgrade}) && {mark_success} || {mark_failure}; {update_metadata}; echo '{done}'".format(
-                wait=wait_until_end_of_yunohost_command,
-                dist_upgrade=dist_upgrade,
-                mark_success=mark_success,
-                mark_failure=mark_failure,
-                update_metadata=update_log_metadata,
-                done=upgrade_completed,
-            )
+            command = [
+                "/usr/bin/python3",
+                helper_path,
+                MOULINETTE_LOCK,
+                operation_logger.log_path,
+                operation_logger.md_path,
+                upgrade_completed,
+            ] + shlex.split(dist_upgrade)
 
             logger.warning(m18n.n("tools_upgrade_special_packages_explanation"))
-            logger.debug("Running command :\n{}".format(command))
-            open("/tmp/yunohost-selfupgrade", "w").write(
-                "rm /tmp/yunohost-selfupgrade; " + command
-            )
+            logger.debug("Running command :\n{}".format(" ".join(command)))
+
             # Using systemd-run --scope is like nohup/disown and &, but more robust somehow
             # (despite using nohup/disown and &, the self-upgrade process was still getting killed...)
             # ref: https://unix.stackexchange.com/questions/420594/why-process-killed-with-nohup
             # (though I still don't understand it 100%...)
-            os.system("systemd-run --scope bash /tmp/yunohost-selfupgrade &")
+            subprocess.Popen(
+                ["systemd-run", "--scope"] + command, start_new_session=True
+            )
             return
 
         else:
@@ -896,15 +998,20 @@ def tools_migrations_run(
     all_migrations = _get_migrations_list()
 
     # Small utility that allows up to get a migration given a name, id or number later
+    by_id = {m.id: m for m in all_migrations}
+    by_name = {m.name: m for m in all_migrations}
+    by_number = {m.id.split("_")[0]: m for m in all_migrations}
+
     def get_matching_migration(target):
-        for m in all_migrations:
-            if m.id == target or m.name == target or m.id.split("_")[0] == target:
-                return m
+        for lookup in (by_id, by_name, by_number):
+            if target in lookup:
+                return lookup[target]
 
         raise YunohostValidationError("migrations_no_such_migration", id=target)
 
     # auto, skip and force are exclusive options
-    if auto + skip + force_rerun > 1:
+    modes = {"auto": auto, "skip": skip, "force_rerun": force_rerun}
+    if sum(bool(enabled) for enabled in modes.values()) > 1:
         raise YunohostValidationError("migrations_exclusive_options")
 
     # If no target specified
@@ -919,8 +1026,9 @@ def tools_migrations_run(
     # If explicit targets are provided, we shall validate them
     else:
         targets = [get_matching_migration(t) for t in targets]
-        done = [t.id for t in targets if t.state != "pending"]
-        pending = [t.id for t in targets if t.state == "pending"]
+        done, pending = [], []
+        for t in targets:
+            (pending if t.state == "pending" else done).append(t.id)
 
         if skip and done:
             raise YunohostValidationError(
@@ -938,100 +1046,167 @@ def tools_migrations_run(
         logger.info(m18n.n("migrations_no_migrations_to_run"))
         return
 
+    # Keep track of the states in memory, and only write them when a migration
+    # actually ran (so that it's never forgotten) and once at the very end
+    states = tools_migrations_state()
+    states = dict(states, migrations=dict(states["migrations"]))
+    states_changed = False
+
+    def flush_states():
+        nonlocal states_changed
+        if states_changed:
+            states_changed = False
+            _write_migrations_state(states)
+
     # Actually run selected migrations
-    for migration in targets:
-
-        # If we are migrating in "automatic mode" (i.e. from debian configure
-        # during an upgrade of the package) but we are asked for running
-        # migrations to be ran manually by the user, stop there and ask the
-        # user to run the migration manually.
-        if auto and migration.mode == "manual":
-            logger.warn(m18n.n("migrations_to_be_ran_manually", id=migration.id))
-
-            # We go to the next migration
-            continue
-
-        # Check for migration dependencies
-        if not skip:
-            dependencies = [
-                get_matching_migration(dep) for dep in migration.dependencies
-            ]
-            pending_dependencies = [
-                dep.id for dep in dependencies if dep.state == "pending"
-            ]
-            if pending_dependencies:
-                logger.error(
-                    m18n.n(
-                        "migrations_dependencies_not_satisfied",
-                        id=migration.id,
-                        dependencies_id=", ".join(pending_dependencies),
-                    )
-                )
+    try:
+        for migration in targets:
+
+            # If we are migrating in "automatic mode" (i.e. from debian configure
+            # during an upgrade of the package) but we are asked for running
+            # migrations to be ran manually by the user, stop there and ask the
+            # user to run the migration manually.
+            if auto and migration.mode == "manual":
+                logger.warn(m18n.n("migrations_to_be_ran_manually", id=migration.id))
+
+                # We go to the next migration
                 continue
 
-        # If some migrations have disclaimers (and we're not trying to skip them)
-        if migration.disclaimer and not skip:
-            # require the --accept-disclaimer option.
-            # Otherwise, go to the next migration
-            if not accept_disclaimer:
-                logger.warn(
-                    m18n.n(
-                        "migrations_need_to_accept_disclaimer",
-                        id=migration.id,
-                        disclaimer=migration.disclaimer,
+            # Check for migration dependencies
+            if not skip:
+                dependencies = [
+                    get_matching_migration(dep) for dep in migration.dependencies
+                ]
+                pending_dependencies = [
+                    dep.id for dep in dependencies if dep.state == "pending"
+                ]
+                if pending_dependencies:
+                    logger.error(
+                        m18n.n(
+                            "migrations_dependencies_not_satisfied",
+                            id=migration.id,
+                            dependencies_id=", ".join(pending_dependencies),
+                        )
                     )
-                )
-                continue
-            # --accept-disclaimer will only work for the first migration
+                    continue
+
+            # If some migrations have disclaimers (and we're not trying to skip them)
+            # (computing a disclaimer may be costly, e.g. 0015 looks for
+            # manually modified conf files, so only do it once)
+            disclaimer = migration.disclaimer if not skip else None
+            if disclaimer:
+                # require the --accept-disclaimer option.
+                # Otherwise, go to the next migration
+                if not accept_disclaimer:
+                    logger.warn(
+                        m18n.n(
+                            "migrations_need_to_accept_disclaimer",
+                            id=migration.id,
+                            disclaimer=disclaimer,
+                        )
+                    )
+                    continue
+                # --accept-disclaimer will only work for the first migration
+                else:
+                    accept_disclaimer = False
+
+            # Start register change on system
+            operation_logger = OperationLogger("tools_migrations_migrate_forward")
+            operation_logger.start()
+
+            if skip:
+                logger.warn(m18n.n("migrations_skip_migration", id=migration.id))
+                migration.state = "skipped"
+                states["migrations"][migration.id] = "skipped"
+                states_changed = True
+                operation_logger.success()
             else:
-                accept_disclaimer = False
-
-        # Start register change on system
-        operation_logger = OperationLogger("tools_migrations_migrate_forward")
-        operation_logger.start()
-
-        if skip:
-            logger.warn(m18n.n("migrations_skip_migration", id=migration.id))
-            migration.state = "skipped"
-            _write_migration_state(migration.id, "skipped")
-            operation_logger.success()
-        else:
 
-            try:
-                migration.operation_logger = operation_logger
-                logger.info(m18n.n("migrations_running_forward", id=migration.id))
-                migration.run()
-            except Exception as e:
-                # migration failed, let's stop here but still update state because
-                # we managed to run the previous ones
-                msg = m18n.n(
-                    "migrations_migration_has_failed", exception=e, id=migration.id
-                )
-                logger.error(msg, exc_info=1)
-                operation_logger.error(msg)
-            else:
-                logger.success(m18n.n("migrations_success_forward", id=migration.id))
-                migration.state = "done"
-                _write_migration_state(migration.id, "done")
+                try:
+                    migration.operation_logger = operation_logger
+                    logger.info(m18n.n("migrations_running_forward", id=migration.id))
+                    migration.run()
+                except Exception as e:
+                    # migration failed, let's stop here but still update state because
+                    # we managed to run the previous ones
+                    msg = m18n.n(
+                        "migrations_migration_has_failed", exception=e, id=migration.id
+                    )
+                    logger.error(msg, exc_info=1)
+                    operation_logger.error(msg)
+                else:
+                    logger.success(
+                        m18n.n("migrations_success_forward", id=migration.id)
+                    )
+                    migration.state = "done"
+                    states["migrations"][migration.id] = "done"
+                    states_changed = True
+                    flush_states()
 
-                operation_logger.success()
+                    operation_logger.success()
+    finally:
+        flush_states()
 
 
 def tools_migrations_state():
     """
     Show current migration state
     """
-    if not os.path.exists(MIGRATIONS_STATE_PATH):
+    global _MIGRATIONS_STATE_CACHE
+
+    try:
+        st = os.stat(MIGRATIONS_STATE_PATH)
+    except FileNotFoundError:
         return {"migrations": {}}
 
-    return read_yaml(MIGRATIONS_STATE_PATH)
+    # Only parse the file again if it changed since the last time
+    key = (st.st_mtime_ns, st.st_size)
+    if _MIGRATIONS_STATE_CACHE is None or _MIGRATIONS_STATE_CACHE[0] != key:
+        _MIGRATIONS_STATE_CACHE = (key, read_yaml(MIGRATIONS_STATE_PATH))
+
+    return _MIGRATIONS_STATE_CACHE[1]
+
+
+def _invalidate_migrations_state_cache():
+    global _MIGRATIONS_STATE_CACHE
+    _MIGRATIONS_STATE_CACHE = None
+
+
+def _atomic_write_yaml(path, data):
+    """
+    Write data as yaml in path, such that a crash at any point leaves either
+    the previous or the new content, never a truncated file
+    """
+
+    content = yaml.safe_dump(data, default_flow_style=False).encode("utf-8")
+
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # Make sure the rename itself is on disk too
+    dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 
-def _write_migration_state(migration_id, state):
+def _write_migrations_state(states):
 
-    current_states = tools_migrations_state()
-    current_states["migrations"][migration_id] = state
-    write_to_yaml(MIGRATIONS_STATE_PATH, current_states)
+    try:
+        _atomic_write_yaml(MIGRATIONS_STATE_PATH, states)
+    finally:
+        _invalidate_migrations_state_cache()
 
 
 def _get_migrations_list():
@@ -1060,16 +1235,76 @@ def _get_migrations_list():
     # (in particular, pending migrations / not already ran are not listed
     states = tools_migrations_state()["migrations"]
 
-    for migration_file in [
-        x
-        for x in os.listdir(migrations_path)
-        if re.match(r"^\d+_[a-zA-Z0-9_]+\.py$", x)
-    ]:
-        m = _load_migration(migration_file)
-        m.state = states.get(m.id, "pending")
-        migrations.append(m)
+    # The migration modules themselves are only imported when needed
+    # (and fresh objects are built each time, since callers change their state)
+    dir_mtime = os.stat(migrations_path).st_mtime_ns
+    for migration_id in _list_migration_ids(migrations_path, dir_mtime):
+        migrations.append(
+            _LazyMigration(migration_id, states.get(migration_id, "pending"))
+        )
+
+    return migrations
+
+
+@lru_cache(maxsize=4)
+def _list_migration_ids(migrations_path, dir_mtime):
+    """
+    Sorted ids of the migrations found in migrations_path. dir_mtime is only
+    there to scan the directory again whenever a file is added or removed
+    """
+
+    with os.scandir(migrations_path) as it:
+        migration_files = [
+            e.name
+            for e in it
+            if _MIGRATION_FILE_RE.match(e.name) and e.is_file(follow_symlinks=False)
+        ]
+
+    return tuple(sorted(f[: -len(".py")] for f in migration_files))
+
+
+class _LazyMigration(object):
+    """
+    Stands for a migration whose module is only imported (through
+    _load_migration) the first time something else than its id, number, name,
+    state or description is needed. Migration modules import a lot of stuff,
+    and most of the time we only care about the state of the migrations.
+    """
+
+    _own_attributes = ("id", "number", "name", "state", "_migration")
 
-    return sorted(migrations, key=lambda m: m.id)
+    def __init__(self, id_, state="pending"):
+        self._migration = None
+        self.id = id_
+        number, self.name = id_.split("_", 1)
+        self.number = int(number)
+        self.state = state
+
+    @property
+    def description(self):
+        return m18n.n("migration_description_%s" % self.id)
+
+    def _load(self):
+        if self._migration is None:
+            migration = _load_migration(self.id + ".py")
+            migration.state = self.state
+            object.__setattr__(self, "_migration", migration)
+        return self._migration
+
+    def __getattr__(self, name):
+        # (only called for attributes not found on the object itself)
+        if name == "_migration" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        if name not in self._own_attributes:
+            setattr(self._load(), name, value)
+            return
+        object.__setattr__(self, name, value)
+        # Keep the state of the actual migration in sync
+        if name == "state" and self._migration is not None:
+            self._migration.state = value
 
 
 def _get_migration_by_name(migration_name):
@@ -1083,11 +1318,13 @@ def _get_migration_by_name(migration_name):
         raise AssertionError("Unable to find migration with name %s" % migration_name)
 
     migrations_path = data_migrations.__path__[0]
-    migrations_found = [
-        x
-        for x in os.listdir(migrations_path)
-        if re.match(r"^\d+_%s\.py$" % migration_name, x)
-    ]
+    migrations_found = []
+    with os.scandir(migrations_path) as it:
+        for e in it:
+            match = _MIGRATION_FILE_RE.match(e.name)
+            if match and match.group("name") == migration_name:
+                if e.is_file(follow_symlinks=False):
+                    migrations_found.append(e.name)
 
     assert len(migrations_found) == 1, (
         "Unable to find migration with name %s" % migration_name
@@ -1128,61 +1365,193 @@ def _skip_all_migrations():
     new_states = {"migrations": {}}
     for migration in all_migrations:
         new_states["migrations"][migration.id] = "skipped"
-    write_to_yaml(MIGRATIONS_STATE_PATH, new_states)
+    _write_migrations_state(new_states)
 
 
-def _tools_migrations_run_after_system_restore(backup_version):
+@lru_cache(maxsize=None)
+def _parse_version(version_string):
+    return version.parse(version_string)
+
+
+# (hook, migration ids) -> (versions, ids) of the migrations having the hook,
+# sorted by version, cf _migrations_introduced_after
+_MIGRATIONS_RESTORE_HOOKS = {}
 
-    all_migrations = _get_migrations_list()
 
-    current_version = version.parse(ynh_packages_version()["yunohost"]["version"])
-    backup_version = version.parse(backup_version)
+def _migrations_introduced_after(backup_version, hook):
+    """
+    Migrations implementing the given restore hook which were introduced
+    after backup_version, in their usual (id) order
+
+    Which migrations have the hook (and since which version) is only looked
+    up once for a given set of migrations, since restoring several apps calls
+    this again for each of them. The migration objects themselves are fresh
+    ones on each call, like _get_migrations_list
+    """
+
+    migrations = {m.id: m for m in _get_migrations_list()}
+
+    key = (hook, tuple(migrations))
+    if key not in _MIGRATIONS_RESTORE_HOOKS:
+        with_hook = sorted(
+            (
+                (_parse_version(m.introduced_in_version), m.id)
+                for m in migrations.values()
+                if hasattr(m, "introduced_in_version") and hasattr(m, hook)
+            ),
+            key=itemgetter(0),
+        )
+        # Forget about what was found for another set of migrations
+        for old_key in [k for k in _MIGRATIONS_RESTORE_HOOKS if k[0] == hook]:
+            del _MIGRATIONS_RESTORE_HOOKS[old_key]
+        _MIGRATIONS_RESTORE_HOOKS[key] = (
+            [v for v, _ in with_hook],
+            [id_ for _, id_ in with_hook],
+        )
+
+    versions, ids = _MIGRATIONS_RESTORE_HOOKS[key]
+    newer = ids[bisect_right(versions, backup_version) :]
+    return [migrations[id_] for id_ in sorted(newer)]
+
+
+def _tools_migrations_run_after_system_restore(backup_version):
+
+    current_version = _parse_version(ynh_packages_version()["yunohost"]["version"])
+    backup_version = _parse_version(backup_version)
 
     if backup_version == current_version:
         return
 
-    for migration in all_migrations:
-        if (
-            hasattr(migration, "introduced_in_version")
-            and version.parse(migration.introduced_in_version) > backup_version
-            and hasattr(migration, "run_after_system_restore")
-        ):
-            try:
-                logger.info(m18n.n("migrations_running_forward", id=migration.id))
-                migration.run_after_system_restore()
-            except Exception as e:
-                msg = m18n.n(
-                    "migrations_migration_has_failed", exception=e, id=migration.id
-                )
-                logger.error(msg, exc_info=1)
-                raise
+    for migration in _migrations_introduced_after(
+        backup_version, "run_after_system_restore"
+    ):
+        try:
+            logger.info(m18n.n("migrations_running_forward", id=migration.id))
+            migration.run_after_system_restore()
+        except Exception as e:
+            msg = m18n.n(
+                "migrations_migration_has_failed", exception=e, id=migration.id
+            )
+            logger.error(msg, exc_info=1)
+            raise
 
 
 def _tools_migrations_run_before_app_restore(backup_version, app_id):
 
-    all_migrations = _get_migrations_list()
-
-    current_version = version.parse(ynh_packages_version()["yunohost"]["version"])
-    backup_version = version.parse(backup_version)
+    current_version = _parse_version(ynh_packages_version()["yunohost"]["version"])
+    backup_version = _parse_version(backup_version)
 
     if backup_version == current_version:
         return
 
-    for migration in all_migrations:
-        if (
-            hasattr(migration, "introduced_in_version")
-            and version.parse(migration.introduced_in_version) > backup_version
-            and hasattr(migration, "run_before_app_restore")
-        ):
+    for migration in _migrations_introduced_after(
+        backup_version, "run_before_app_restore"
+    ):
+        try:
+            logger.info(m18n.n("migrations_running_forward", id=migration.id))
+            migration.run_before_app_restore(app_id)
+        except Exception as e:
+            msg = m18n.n(
+                "migrations_migration_has_failed", exception=e, id=migration.id
+            )
+            logger.error(msg, exc_info=1)
+            raise
+
+
+def _reflink_or_copy2(src, dst):
+    """
+    Same as shutil.copy2, but first try to clone the file (which is almost
+    free on copy-on-write filesystems such as btrfs or xfs), or at least to
+    copy it in-kernel
+    """
+    import fcntl
+
+    FICLONE = 0x40049409
+
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
             try:
-                logger.info(m18n.n("migrations_running_forward", id=migration.id))
-                migration.run_before_app_restore(app_id)
-            except Exception as e:
-                msg = m18n.n(
-                    "migrations_migration_has_failed", exception=e, id=migration.id
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                if not hasattr(os, "copy_file_range"):  # Python >= 3.8
+                    raise
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 2 ** 30):
+                    pass
+    except OSError:
+        return shutil.copy2(src, dst)
+
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _copytree_preserve(src, dst):
+    """
+    Equivalent of 'cp -r --preserve src dst': copytree doesn't keep the owner
+    of what it copies, which matters e.g. for /var/lib/ldap (openldap:openldap)
+    """
+
+    shutil.copytree(src, dst, symlinks=True, copy_function=_reflink_or_copy2)
+
+    for root, dirs, files in os.walk(src):
+        for name in [""] + dirs + files:
+            path = os.path.join(root, name) if name else root
+            st = os.lstat(path)
+            copied = os.path.join(dst, os.path.relpath(path, src))
+            os.lchown(copied, st.st_uid, st.st_gid)
+
+
+# What ldap_migration saves before running the migration (and restores if it
+# fails), and where in the backup folder
+_LDAP_MIGRATION_BACKUP = [
+    ("/etc/ldap", "ldap_config"),
+    ("/var/lib/ldap", "ldap_db"),
+    ("/etc/yunohost/apps", "apps_settings"),
+]
+
+
+def _ldap_snapshot(backup_folder):
+    """
+    Copy the LDAP config, database and the apps settings in backup_folder,
+    with slapd stopped during the copy
+    """
+
+    os.makedirs(backup_folder, mode=0o750, exist_ok=True)
+
+    subprocess.run(["systemctl", "stop", "slapd"], check=True)
+    try:
+        # Those are independent and mostly I/O, copy them at the same
+        # time to keep slapd down for as short as possible
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            copies = [
+                executor.submit(
+                    _copytree_preserve, src, os.path.join(backup_folder, dest)
                 )
-                logger.error(msg, exc_info=1)
-                raise
+                for src, dest in _LDAP_MIGRATION_BACKUP
+            ]
+            for copy in copies:
+                copy.result()
+    finally:
+        subprocess.run(["systemctl", "start", "slapd"])
+
+
+def _ldap_rollback(backup_folder):
+    """
+    Put back what _ldap_snapshot saved in backup_folder
+    """
+
+    subprocess.run(["systemctl", "stop", "slapd"], check=True)
+    try:
+        # To be sure that we don't keep some part of the old config
+        shutil.rmtree("/etc/ldap/slapd.d", ignore_errors=True)
+        # (copytree can't copy into an existing folder before
+        # python 3.8, hence cp, but without going through a shell)
+        for dest, src in _LDAP_MIGRATION_BACKUP:
+            subprocess.run(
+                ["cp", "-r", "--preserve", f"{backup_folder}/{src}/.", dest + "/"],
+                check=True,
+            )
+    finally:
+        subprocess.run(["systemctl", "start", "slapd"])
 
 
 class Migration(object):
@@ -1203,8 +1572,8 @@ class Migration(object):
 
     def __init__(self, id_):
         self.id = id_
-        self.number = int(self.id.split("_", 1)[0])
-        self.name = self.id.split("_", 1)[1]
+        number, self.name = id_.split("_", 1)
+        self.number = int(number)
 
     @property
     def description(self):
@@ -1215,23 +1584,15 @@ class Migration(object):
 
             # Backup LDAP before the migration
             logger.info(m18n.n("migration_ldap_backup_before_migration"))
+            backup_folder = "/home/yunohost.backup/premigration/" + time.strftime(
+                "%Y%m%d-%H%M%S", time.gmtime()
+            )
             try:
-                backup_folder = "/home/yunohost.backup/premigration/" + time.strftime(
-                    "%Y%m%d-%H%M%S", time.gmtime()
-                )
-                os.makedirs(backup_folder, 0o750)
-                os.system("systemctl stop slapd")
-                os.system(f"cp -r --preserve /etc/ldap {backup_folder}/ldap_config")
-                os.system(f"cp -r --preserve /var/lib/ldap {backup_folder}/ldap_db")
-                os.system(
-                    f"cp -r --preserve /etc/yunohost/apps {backup_folder}/apps_settings"
-                )
+                _ldap_snapshot(backup_folder)
             except Exception as e:
                 raise YunohostError(
                     "migration_ldap_can_not_backup_before_migration", error=str(e)
                 )
-            finally:
-                os.system("systemctl start slapd")
 
             try:
                 run(self, backup_folder)
@@ -1239,19 +1600,11 @@ class Migration(object):
                 logger.warning(
                     m18n.n("migration_ldap_migration_failed_trying_to_rollback")
                 )
-                os.system("systemctl stop slapd")
-                # To be sure that we don't keep some part of the old config
-                os.system("rm -r /etc/ldap/slapd.d")
-                os.system(f"cp -r --preserve {backup_folder}/ldap_config/. /etc/ldap/")
-                os.system(f"cp -r --preserve {backup_folder}/ldap_db/. /var/lib/ldap/")
-                os.system(
-                    f"cp -r --preserve {backup_folder}/apps_settings/. /etc/yunohost/apps/"
-                )
-                os.system("systemctl start slapd")
-                os.system(f"rm -r {backup_folder}")
+                _ldap_rollback(backup_folder)
+                shutil.rmtree(backup_folder)
                 logger.info(m18n.n("migration_ldap_rollback_success"))
                 raise
             else:
-                os.system(f"rm -r {backup_folder}")
+                shutil.rmtree(backup_folder)
 
         return func
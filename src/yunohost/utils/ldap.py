@@ -68,6 +68,44 @@ def assert_slapd_is_running():
         )
 
 
+def _ldap_add_many(entries):
+    """
+    Add several entries to the LDAP, sending all the add requests before
+    waiting for their results (instead of one round-trip per entry)
+
+    Keyword argument:
+        entries -- List of (rdn, attr_dict) tuples. Entries shouldn't depend
+                   on each other since slapd may process them in any order
+
+    Returns:
+        The list of (rdn, attr_dict, exception) that could not be added
+    """
+    from ldap import modlist
+
+    interface = _get_ldap_interface()
+
+    failed = []
+    pending = []
+    for rdn, attr_dict in entries:
+        try:
+            dn = rdn + "," + interface.basedn
+            ldif = [
+                (k, [v.encode("utf-8") for v in (vs if isinstance(vs, list) else [vs])])
+                for k, vs in modlist.addModlist(attr_dict)
+            ]
+            pending.append((rdn, attr_dict, interface.con.add(dn, ldif)))
+        except Exception as e:
+            failed.append((rdn, attr_dict, e))
+
+    for rdn, attr_dict, msgid in pending:
+        try:
+            interface.con.result(msgid)
+        except Exception as e:
+            failed.append((rdn, attr_dict, e))
+
+    return failed
+
+
 # We regularly want to extract stuff like 'bar' in ldap path like
 # foo=bar,dn=users.example.org,ou=example.org,dc=org so this small helper allow
 # to do this without relying of dozens of mysterious string.split()[0]
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2021 YUNOHOST.ORG
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+
+""" selfupgrade.py
+
+    Upgrade the critical packages (yunohost, moulinette, ...) once the current
+    yunohost command is over, and mark the corresponding operation log as done.
+
+    This is launched by 'yunohost tools upgrade system' from a copy in /tmp,
+    because the upgrade replaces this very file. Hence it should only rely on
+    the standard library.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+from datetime import datetime
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lock", help="Wait for this file to disappear first")
+    parser.add_argument("logfile", help="Log file of the operation")
+    parser.add_argument("md_path", help="Metadata file of the operation")
+    parser.add_argument("done", help="Message to display at the very end")
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    os.remove(sys.argv[0])
+
+    # Wait for the end of the current yunohost command
+    while os.path.exists(args.lock):
+        time.sleep(2)
+
+    # Leading VAR=value items are environment variables, as in a shell
+    command = list(args.command)
+    env = dict(os.environ)
+    while command and re.match(r"^[A-Za-z_][A-Za-z0-9_]*=", command[0]):
+        key, value = command.pop(0).split("=", 1)
+        env[key] = value
+
+    success = False
+    try:
+        with open(args.logfile, "ab") as log:
+
+            # Like tee : the log comes first, and if the terminal we were
+            # started from is gone, just stop echoing and keep going
+            echo = True
+
+            def output(data):
+                nonlocal echo
+                log.write(data)
+                log.flush()
+                if echo:
+                    try:
+                        sys.stdout.buffer.write(data)
+                        sys.stdout.buffer.flush()
+                    except OSError:
+                        echo = False
+
+            p = subprocess.Popen(
+                command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            for line in p.stdout:
+                output(line)
+            success = p.wait() == 0
+
+            output(b"Done!\n" if success else b"Failed :(\n")
+    finally:
+        update_log_metadata(args.md_path, success)
+
+    try:
+        print(args.done, flush=True)
+    except OSError:
+        pass
+
+
+def update_log_metadata(md_path, success):
+
+    with open(md_path) as md:
+        metadata = md.read()
+
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+    metadata = re.sub(r"^ended_at: .*$", "ended_at: %s" % now, metadata, flags=re.M)
+    if metadata and not metadata.endswith("\n"):
+        metadata += "\n"
+    metadata += "success: %s\n" % ("true" if success else "false")
+
+    # Write both changes at once, and atomically (this file can't rely on
+    # yunohost's own helpers, cf the top of the file, hence doing it here)
+    tmp_path = md_path + ".tmp"
+    with open(tmp_path, "w") as md:
+        md.write(metadata)
+        md.flush()
+        os.fsync(md.fileno())
+    os.replace(tmp_path, md_path)
+
+    dir_fd = os.open(os.path.dirname(md_path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+if __name__ == "__main__":
+    main()